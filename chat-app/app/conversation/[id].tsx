@@ -101,9 +101,11 @@ const Conversation: React.FC = () => {
   }, [messages]);
 
   useEffect(() => {
+    let service: WebRTCService | null = null;
+
     const initializeWebRTC = async () => {
       if (currentUser?.userId && recipient?.userId && sharedSecret) {
-        const service = new WebRTCService(currentUser.userId);
+        service = new WebRTCService(currentUser.userId);
         service.setOnMessageCallback((message) => {
           console.warn("sharedSecret in callback:", sharedSecret);
           const decryptedMessage = {
@@ -112,17 +114,21 @@ const Conversation: React.FC = () => {
           };
           setMessages((prev) => [...prev, decryptedMessage]);
         });
+        setWebRTCService(service);
         await service.joinRoom(
           `chat_${currentUser.userId}_${recipient.userId}`
         );
-        setWebRTCService(service);
+        await service.connectToPeer(recipient.userId);
       }
     };
 
     initializeWebRTC();
     return () => {
-      if (webRTCService) {
-        webRTCService.setOnMessageCallback(() => {});
+      // Leaving (or re-running with a new secret) drops this socket so the
+      // server releases its seat in the call for the next service to join
+      if (service) {
+        service.setOnMessageCallback(() => {});
+        service.disconnect();
       }
     };
   }, [currentUser?.userId, recipient?.userId, sharedSecret]);
@@ -1,17 +1,30 @@
 import io from 'socket.io-client';
 
+// A user's previous socket (e.g. from an earlier visit to the conversation)
+// holds their seat in a call until the server sees it disconnect
+const ALREADY_IN_CALL = 'User is already connected to this call';
+const JOIN_RETRIES = 5;
+const JOIN_RETRY_DELAY_MS = 500;
+
 
 export interface UserProfile {
   userId: string;
   profilePicture?: string;
 }
 
+interface IceCandidateSignal {
+  sender_id: string;
+  candidate: RTCIceCandidateInit;
+  call_id?: string;
+}
+
 export class WebRTCService {
   private socket: any;
   private peerConnections: Map<string, RTCPeerConnection> = new Map();
   private dataChannels: Map<string, RTCDataChannel> = new Map();
   private onMessageCallback: ((message: any) => void) | null = null;
   private onProfileUpdateCallback: ((profile: UserProfile) => void) | null = null;
+  private callId: string | null = null;
   
 
   constructor(private userId: string) {
@@ -61,7 +74,7 @@ export class WebRTCService {
     });
     
 
-    this.socket.on('offer', async (data: { sender_id: string; offer: RTCSessionDescriptionInit }) => {
+    this.socket.on('offer', async (data: { sender_id: string; offer: RTCSessionDescriptionInit; call_id?: string }) => {
       console.log('Received offer from', data.sender_id);
       const peerConnection = this.createPeerConnection(data.sender_id);
       await peerConnection.setRemoteDescription(new RTCSessionDescription(data.offer));
@@ -70,7 +83,8 @@ export class WebRTCService {
       console.log('Sending answer to', data.sender_id);
       this.socket.emit('answer', {
         sender_id: data.sender_id,
-        answer
+        answer,
+        ...(data.call_id ? { call_id: data.call_id } : {})
       });
     });
 
@@ -82,12 +96,42 @@ export class WebRTCService {
       }
     });
 
-    this.socket.on('ice_candidate', async (data: { sender_id: string; candidate: RTCIceCandidateInit }) => {
-      console.log('Received ICE candidate from', data.sender_id);
-      const peerConnection = this.peerConnections.get(data.sender_id);
-      if (peerConnection) {
-        await peerConnection.addIceCandidate(new RTCIceCandidate(data.candidate));
+    this.socket.on('ice_candidate', async (data: IceCandidateSignal) => {
+      await this.addRemoteCandidate(data);
+    });
+
+    // Within a call the server batches trickled candidates into one event
+    this.socket.on('ice_candidates', async (data: { call_id: string; candidates: IceCandidateSignal[] }) => {
+      console.log(`Received ${data.candidates.length} ICE candidates for call`, data.call_id);
+      for (const candidate of data.candidates) {
+        await this.addRemoteCandidate(candidate);
+      }
+    });
+
+    this.socket.on('peer_joined', async (data: { call_id: string; user_id: string }) => {
+      console.log('Peer joined call', data.call_id, data.user_id);
+      // If our offer is still unanswered, the server buffered it and the peer
+      // got it on joining. Otherwise the peer is new or came back after a
+      // reload/reconnect, and needs a fresh offer from us.
+      const existing = this.peerConnections.get(data.user_id);
+      if (existing && !existing.remoteDescription) {
+        return;
+      }
+      this.closePeerConnection(data.user_id);
+      await this.sendOffer(data.user_id, data.call_id);
+    });
+
+    this.socket.on('peer_left', (data: { call_id: string; user_id: string }) => {
+      console.log('Peer left call', data.call_id, data.user_id);
+      this.closePeerConnection(data.user_id);
+    });
+
+    this.socket.on('call_ended', (data: { call_id: string; reason: string }) => {
+      console.log('Call ended', data.call_id, data.reason);
+      if (this.callId === data.call_id) {
+        this.callId = null;
       }
+      this.peerConnections.forEach((_, userId) => this.closePeerConnection(userId));
     });
 
     this.socket.on('message', (message: any) => {
@@ -100,6 +144,36 @@ export class WebRTCService {
 
   
 
+  private async addRemoteCandidate(data: IceCandidateSignal) {
+    console.log('Received ICE candidate from', data.sender_id);
+    const peerConnection = this.peerConnections.get(data.sender_id);
+    if (peerConnection) {
+      await peerConnection.addIceCandidate(new RTCIceCandidate(data.candidate));
+    }
+  }
+
+  private closePeerConnection(userId: string) {
+    this.peerConnections.get(userId)?.close();
+    this.peerConnections.delete(userId);
+    this.dataChannels.delete(userId);
+  }
+
+  private emitWithAck(event: string, data: any): Promise<any> {
+    return new Promise((resolve) => {
+      this.socket.emit(event, data, (response: any) => resolve(response || {}));
+    });
+  }
+
+  private async joinCall(callId: string): Promise<any> {
+    for (let attempt = 0; ; attempt++) {
+      const response = await this.emitWithAck('join_call', { call_id: callId, user_id: this.userId });
+      if (response.error !== ALREADY_IN_CALL || attempt >= JOIN_RETRIES || this.socket.disconnected) {
+        return response;
+      }
+      await new Promise((resolve) => setTimeout(resolve, JOIN_RETRY_DELAY_MS));
+    }
+  }
+
   private createPeerConnection(recipientId: string): RTCPeerConnection {
     if (this.peerConnections.has(recipientId)) {
       return this.peerConnections.get(recipientId)!;
@@ -124,7 +198,8 @@ export class WebRTCService {
         console.log('ICE Candidate', event.candidate);
         this.socket.emit('ice_candidate', {
           recipient_id: recipientId,
-          candidate: event.candidate
+          candidate: event.candidate,
+          ...(this.callId ? { call_id: this.callId } : {})
         });
       }
     };
@@ -168,6 +243,62 @@ export class WebRTCService {
     });
   }
 
+  /**
+   * Join the call shared with `recipientId`, or start it and send the offer.
+   * Signals sent before the peer joins are buffered by the server. Whoever is
+   * already in the call re-offers when the other side (re)joins.
+   */
+  public async connectToPeer(recipientId: string) {
+    const callId = `call_${[this.userId, recipientId].sort().join('_')}`;
+    // Set before joining: buffered signals are delivered ahead of the ack
+    this.callId = callId;
+
+    const joined = await this.joinCall(callId);
+    if (!joined.error) {
+      return;
+    }
+    if (joined.error === ALREADY_IN_CALL) {
+      console.error('Failed to join call:', joined.error);
+      this.callId = null;
+      return;
+    }
+
+    const started = await this.emitWithAck('start_call', {
+      call_id: callId,
+      user_id: this.userId,
+      invitees: [recipientId]
+    });
+    if (started.error) {
+      // The peer started the call between our join and start attempts
+      const retried = await this.joinCall(callId);
+      if (retried.error) {
+        console.error('Failed to join call:', retried.error);
+        this.callId = null;
+      }
+      return;
+    }
+
+    await this.sendOffer(recipientId, callId);
+  }
+
+  private async sendOffer(recipientId: string, callId: string) {
+    const peerConnection = this.createPeerConnection(recipientId);
+    const offer = await peerConnection.createOffer();
+    await peerConnection.setLocalDescription(offer);
+    console.log('Sending offer to', recipientId);
+    this.socket.emit('offer', {
+      recipient_id: recipientId,
+      call_id: callId,
+      offer
+    });
+  }
+
+  public async endCall() {
+    if (this.callId) {
+      this.socket.emit('end_call', { call_id: this.callId });
+    }
+  }
+
   public async sendMessage(recipientId: string, message: any) {
     try {
       const messageString = JSON.stringify(message);
@@ -194,6 +325,7 @@ export class WebRTCService {
     });
     this.peerConnections.clear();
     this.dataChannels.clear();
+    this.callId = null;
     this.socket.disconnect();
   }
 }
\ No newline at end of file
@@ -1,19 +1,158 @@
 # webrtc.py (Updated)
 from flask import Blueprint, request, jsonify
 from flask_socketio import SocketIO, emit, join_room, leave_room
+from threading import Lock
 from db.db import db
 from models.messages import Message
+from models.calls import CallSession
 
 webrtc_bp = Blueprint('webrtc', __name__)
 socketio = SocketIO()
 message_collection = db.get_collection("messages")
 
+# The first trickle-ICE candidate for a peer is sent at once; those following
+# it within this window are coalesced into one emit
+ICE_BATCH_INTERVAL = 0.005
+# Upper bound on signals held for not-yet-joined invitees, per call
+MAX_PENDING_SIGNALS = 200
+
+call_sessions = {}      # call_id -> CallSession
+sid_calls = {}          # sid -> set of call_ids the socket participates in
+ice_batches = {}        # (call_id, recipient sid) -> [candidates held in the open window]
+# Guards the state above. Signals are also emitted while it is held, so that
+# what one peer sends reaches the other in the same order.
+call_lock = Lock()
+
+
+def _get_call_participant(call_id, sid):
+    # Callers must hold call_lock and keep it while using the session
+    session = call_sessions.get(call_id)
+    if not session:
+        return None, None
+    return session, session.user_for_sid(sid)
+
+
+def _flush_ice_batch(key, candidates):
+    socketio.sleep(ICE_BATCH_INTERVAL)
+    with call_lock:
+        # An offer/answer may have flushed this window and a new one opened
+        if ice_batches.get(key) is not candidates:
+            return
+        del ice_batches[key]
+        if candidates:
+            call_id, recipient_sid = key
+            socketio.emit('ice_candidates', {
+                'call_id': call_id,
+                'candidates': candidates
+            }, to=recipient_sid)
+
+
+def _relay_call_signal(call_id, sender_sid, recipient_user_id, event, payload):
+    """
+    Deliver a signaling message inside a call. The first candidate for a
+    connected peer goes out at once and the rest of its window are batched;
+    anything addressed to a peer that hasn't joined yet is held on
+    the session and flushed when they do.
+    """
+    with call_lock:
+        session, sender_user_id = _get_call_participant(call_id, sender_sid)
+        if not sender_user_id:
+            return {'error': 'Not a participant of this call'}
+        payload = dict(payload, call_id=call_id, sender_id=sender_user_id)
+        recipient_sid = session.participants.get(recipient_user_id)
+        if recipient_sid is None:
+            if recipient_user_id not in session.invitees:
+                return {'error': 'Recipient is not in this call'}
+            if session.pending_count() >= MAX_PENDING_SIGNALS:
+                return {'error': 'Too many pending signals for this call'}
+            session.pending_signals.setdefault(recipient_user_id, []).append((event, payload))
+            return {'status': 'buffered'}
+
+        if event == 'ice_candidate':
+            key = (call_id, recipient_sid)
+            batch = ice_batches.get(key)
+            if batch is not None:
+                batch.append(payload)
+                return {'status': 'success'}
+            socketio.emit('ice_candidates', {'call_id': call_id, 'candidates': [payload]}, to=recipient_sid)
+            batch = ice_batches[key] = []
+            socketio.start_background_task(_flush_ice_batch, key, batch)
+            return {'status': 'success'}
+
+        # Candidates queued before an offer/answer (e.g. ahead of an ICE
+        # restart) must reach the peer first, so flush them now
+        queued = ice_batches.pop((call_id, recipient_sid), None)
+        if queued:
+            socketio.emit('ice_candidates', {'call_id': call_id, 'candidates': queued}, to=recipient_sid)
+        socketio.emit(event, payload, to=recipient_sid)
+    return {'status': 'success'}
+
+
+def _flush_pending_signals(call_id, sid, pending):
+    # Callers must hold call_lock. Runs of consecutive candidates collapse
+    # into one emit; order is kept
+    candidates = []
+    for event, payload in pending:
+        if event == 'ice_candidate':
+            candidates.append(payload)
+            continue
+        if candidates:
+            socketio.emit('ice_candidates', {'call_id': call_id, 'candidates': candidates}, to=sid)
+            candidates = []
+        socketio.emit(event, payload, to=sid)
+    if candidates:
+        socketio.emit('ice_candidates', {'call_id': call_id, 'candidates': candidates}, to=sid)
+
+
+def _teardown_call(call_id, reason):
+    with call_lock:
+        session = call_sessions.pop(call_id, None)
+        if not session:
+            return
+        for sid in session.participants.values():
+            calls = sid_calls.get(sid)
+            if calls:
+                calls.discard(call_id)
+                if not calls:
+                    del sid_calls[sid]
+        for key in [key for key in ice_batches if key[0] == call_id]:
+            del ice_batches[key]
+        sids = list(session.participants.values())
+    for sid in sids:
+        socketio.emit('call_ended', {'call_id': call_id, 'reason': reason}, to=sid)
+    print(f"Call {call_id} ended ({reason})")
+
+
+def _leave_all_calls(sid):
+    notify, ended = [], []
+    with call_lock:
+        for call_id in sid_calls.pop(sid, set()):
+            session = call_sessions.get(call_id)
+            if not session:
+                continue
+            ice_batches.pop((call_id, sid), None)
+            user_id = session.remove_sid(sid)
+            if user_id is None:
+                # The user already rejoined this call from another socket
+                continue
+            if not session.participants:
+                del call_sessions[call_id]
+                ended.append(call_id)
+                continue
+            for peer_sid in session.participants.values():
+                notify.append((peer_sid, {'call_id': call_id, 'user_id': user_id}))
+    for peer_sid, payload in notify:
+        socketio.emit('peer_left', payload, to=peer_sid)
+    for call_id in ended:
+        print(f"Call {call_id} ended (all participants left)")
+
 @socketio.on('connect')
 def handle_connect():
     print(f"Client connected: {request.sid}")
 
 @socketio.on('disconnect')
 def handle_disconnect():
+    _leave_all_calls(request.sid)
     print(f"Client disconnected: {request.sid}")
 
 @socketio.on('join_room')
@@ -59,6 +198,92 @@ def handle_message(data):
         print(f"Error in handle_message: {str(e)}")
         return {'error': str(e)}
 
+@socketio.on('start_call')
+def handle_start_call(data):
+    try:
+        user_id = data.get('user_id')
+        
+        if not user_id:
+            return {'error': 'Missing user_id'}
+        
+        invitees = data.get('invitees') or []
+        if not isinstance(invitees, list):
+            return {'error': 'invitees must be a list of user ids'}
+        
+        session = CallSession(call_id=data.get('call_id'), created_by=user_id, invitees=invitees)
+        with call_lock:
+            if session.call_id in call_sessions:
+                return {'error': 'Call already exists'}
+            session.add_participant(user_id, request.sid)
+            call_sessions[session.call_id] = session
+            sid_calls.setdefault(request.sid, set()).add(session.call_id)
+        
+        print(f"User {user_id} started call {session.call_id}")
+        return {'status': 'success', 'call': session.to_dict()}
+    except Exception as e:
+        print(f"Error in start_call: {str(e)}")
+        return {'error': str(e)}
+
+@socketio.on('join_call')
+def handle_join_call(data):
+    try:
+        call_id = data.get('call_id')
+        user_id = data.get('user_id')
+        
+        if not call_id or not user_id:
+            return {'error': 'Missing call_id or user_id'}
+        
+        with call_lock:
+            session = call_sessions.get(call_id)
+            if not session:
+                return {'error': 'Call not found'}
+            if not session.may_join(user_id):
+                return {'error': 'Not invited to this call'}
+            # Departed sockets are dropped on disconnect, so any sid still
+            # bound here is live. user_id is not authenticated, so a new
+            # socket never takes over; it joins once the old one has left.
+            bound_sid = session.participants.get(user_id)
+            if bound_sid and bound_sid != request.sid:
+                return {'error': 'User is already connected to this call'}
+            if session.user_for_sid(request.sid) not in (None, user_id):
+                return {'error': 'Socket already joined this call as another user'}
+            rejoined = bound_sid == request.sid
+            peers = list(session.participants.items())
+            pending = session.add_participant(user_id, request.sid)
+            sid_calls.setdefault(request.sid, set()).add(call_id)
+            # Buffered signals go out before anything relayed after this join
+            _flush_pending_signals(call_id, request.sid, pending)
+            call = session.to_dict()
+        
+        if not rejoined:
+            for _, peer_sid in peers:
+                emit('peer_joined', {'call_id': call_id, 'user_id': user_id}, to=peer_sid)
+        
+        print(f"User {user_id} joined call {call_id}")
+        return {'status': 'success', 'call': call}
+    except Exception as e:
+        print(f"Error in join_call: {str(e)}")
+        return {'error': str(e)}
+
+@socketio.on('end_call')
+def handle_end_call(data):
+    try:
+        call_id = data.get('call_id')
+        
+        if not call_id:
+            return {'error': 'Missing call_id'}
+        
+        with call_lock:
+            _, user_id = _get_call_participant(call_id, request.sid)
+        if not user_id:
+            return {'error': 'Not a participant of this call'}
+        
+        _teardown_call(call_id, f"ended by {user_id}")
+        return {'status': 'success'}
+    except Exception as e:
+        print(f"Error in end_call: {str(e)}")
+        return {'error': str(e)}
+
 @socketio.on('offer')
 def handle_offer(data):
     try:
@@ -68,6 +293,10 @@ def handle_offer(data):
         if not recipient_id or not offer:
             return {'error': 'Missing recipient or offer'}
         
+        call_id = data.get('call_id')
+        if call_id:
+            return _relay_call_signal(call_id, request.sid, recipient_id, 'offer', {'offer': offer})
+        
         emit('offer', {
             'sender_id': request.sid,
             'offer': offer
@@ -86,6 +315,10 @@ def handle_answer(data):
         if not sender_id or not answer:
             return {'error': 'Missing sender or answer'}
         
+        call_id = data.get('call_id')
+        if call_id:
+            return _relay_call_signal(call_id, request.sid, sender_id, 'answer', {'answer': answer})
+        
         emit('answer', {
             'sender_id': request.sid,
             'answer': answer
@@ -104,6 +337,10 @@ def handle_ice_candidate(data):
         if not recipient_id or not candidate:
             return {'error': 'Missing recipient or candidate'}
         
+        call_id = data.get('call_id')
+        if call_id:
+            return _relay_call_signal(call_id, request.sid, recipient_id, 'ice_candidate', {'candidate': candidate})
+        
         emit('ice_candidate', {
             'sender_id': request.sid,
             'candidate': candidate
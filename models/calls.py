@@ -0,0 +1,52 @@
+import uuid
+from datetime import datetime
+
+class CallSession:
+    def __init__(
+        self,
+        call_id: str = None,
+        created_by: str = None,
+        invitees: list = None,
+        created_at: datetime = None,
+    ):
+        self.call_id = call_id or str(uuid.uuid4())
+        self.created_by = created_by
+        # Only the creator and invited users may join or have signals buffered
+        self.invitees = set(invitees or []) - {created_by}
+        self.created_at = created_at or datetime.utcnow()
+        # user_id -> socket sid of every participant currently connected
+        self.participants = {}
+        # user_id -> [(event, payload)] signals for peers that haven't joined yet
+        self.pending_signals = {}
+
+    def add_participant(self, user_id: str, sid: str):
+        self.participants[user_id] = sid
+        return self.pending_signals.pop(user_id, [])
+
+    def may_join(self, user_id: str):
+        return user_id == self.created_by or user_id in self.invitees
+
+    def pending_count(self):
+        return sum(len(signals) for signals in self.pending_signals.values())
+
+    def remove_sid(self, sid: str):
+        for user_id, participant_sid in list(self.participants.items()):
+            if participant_sid == sid:
+                del self.participants[user_id]
+                return user_id
+        return None
+
+    def user_for_sid(self, sid: str):
+        for user_id, participant_sid in self.participants.items():
+            if participant_sid == sid:
+                return user_id
+        return None
+
+    def to_dict(self):
+        return {
+            'callId': self.call_id,
+            'createdBy': self.created_by,
+            'createdAt': self.created_at.isoformat(),
+            'invitees': sorted(self.invitees),
+            'participants': list(self.participants.keys())
+        }
@@ -0,0 +1,342 @@
+"""
+Signaling checks for controllers/webrtc.py driven through Flask-SocketIO's
+test client, with two (or more) simulated peers.
+
+    python -m pytest -q tests/test_webrtc_signaling.py
+    python tests/test_webrtc_signaling.py     # prints emit counts and timings before/after
+
+MongoDB is not needed: db.db is replaced with a stub before the controller
+is imported.
+"""
+import os
+import statistics
+import sys
+import threading
+import time
+import types
+from unittest.mock import MagicMock
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+db_stub = types.ModuleType('db.db')
+db_stub.db = MagicMock()
+sys.modules.setdefault('db.db', db_stub)
+
+import pytest
+from flask import Flask
+
+from controllers import webrtc
+from controllers.webrtc import socketio
+
+CANDIDATES_PER_PEER = 8
+# Comfortably longer than ICE_BATCH_INTERVAL so background flushes have run
+SETTLE = webrtc.ICE_BATCH_INTERVAL * 10
+
+app = Flask(__name__)
+socketio.init_app(app, async_mode='threading')
+
+
+def reset_state():
+    with webrtc.call_lock:
+        webrtc.call_sessions.clear()
+        webrtc.sid_calls.clear()
+        webrtc.ice_batches.clear()
+
+
+def connect():
+    client = socketio.test_client(app)
+    client.sid = socketio.server.manager.sid_from_eio_sid(client.eio_sid, '/')
+    return client
+
+
+def received(client):
+    time.sleep(SETTLE)
+    return [(msg['name'], msg['args'][0]) for msg in client.get_received()]
+
+
+def candidate(n):
+    return {'candidate': f'candidate:{n} 1 udp 2122260223 10.0.0.1 {5000 + n} typ host'}
+
+
+@pytest.fixture
+def peers():
+    reset_state()
+    alice, bob = connect(), connect()
+    yield alice, bob
+    for client in (alice, bob):
+        if client.is_connected():
+            client.disconnect()
+    reset_state()
+
+
+def start_call(client, user_id, invitees=None, call_id='call-1'):
+    return client.emit('start_call', {
+        'call_id': call_id,
+        'user_id': user_id,
+        'invitees': invitees or []
+    }, callback=True)
+
+
+def join_call(client, user_id, call_id='call-1'):
+    return client.emit('join_call', {'call_id': call_id, 'user_id': user_id}, callback=True)
+
+
+def test_candidates_to_connected_peer_are_batched(peers):
+    alice, bob = peers
+    assert start_call(alice, 'alice', ['bob'])['status'] == 'success'
+    assert join_call(bob, 'bob')['status'] == 'success'
+    received(alice)
+
+    for n in range(CANDIDATES_PER_PEER):
+        ack = alice.emit('ice_candidate', dict(candidate(n), recipient_id='bob', call_id='call-1'), callback=True)
+        assert ack == {'status': 'success'}
+
+    # The first candidate goes out at once, the rest of its window together
+    messages = received(bob)
+    assert [name for name, _ in messages] == ['ice_candidates', 'ice_candidates']
+    assert [len(payload['candidates']) for _, payload in messages] == [1, CANDIDATES_PER_PEER - 1]
+    delivered = [c for _, payload in messages for c in payload['candidates']]
+    assert [c['candidate'] for c in delivered] == \
+        [candidate(n)['candidate'] for n in range(CANDIDATES_PER_PEER)]
+    assert all(c['call_id'] == 'call-1' and c['sender_id'] == 'alice' for c in delivered)
+
+
+def test_first_candidate_is_not_delayed(peers):
+    alice, bob = peers
+    start_call(alice, 'alice', ['bob'])
+    join_call(bob, 'bob')
+    received(alice)
+
+    alice.emit('ice_candidate', dict(candidate(0), recipient_id='bob', call_id='call-1'), callback=True)
+    # No settle time: the emit has already reached bob
+    messages = bob.get_received()
+    assert [msg['name'] for msg in messages] == ['ice_candidates']
+    assert messages[0]['args'][0]['candidates'][0]['candidate'] == candidate(0)['candidate']
+
+
+def test_signals_are_buffered_until_invitee_joins(peers):
+    alice, bob = peers
+    start_call(alice, 'alice', ['bob'])
+
+    ack = alice.emit('offer', {'recipient_id': 'bob', 'call_id': 'call-1', 'offer': {'sdp': 'o1'}}, callback=True)
+    assert ack == {'status': 'buffered'}
+    for n in range(3):
+        alice.emit('ice_candidate', dict(candidate(n), recipient_id='bob', call_id='call-1'), callback=True)
+    assert received(bob) == []
+
+    join_call(bob, 'bob')
+    messages = received(bob)
+    assert [name for name, _ in messages] == ['offer', 'ice_candidates']
+    assert messages[0][1]['offer'] == {'sdp': 'o1'}
+    assert len(messages[1][1]['candidates']) == 3
+    assert webrtc.call_sessions['call-1'].pending_signals == {}
+    assert [name for name, _ in received(alice)] == ['peer_joined']
+
+
+def test_buffering_only_for_invitees_and_capped_per_call(peers, monkeypatch):
+    alice, _ = peers
+    start_call(alice, 'alice', ['bob', 'carol'])
+
+    ack = alice.emit('ice_candidate', dict(candidate(0), recipient_id='mallory', call_id='call-1'), callback=True)
+    assert ack == {'error': 'Recipient is not in this call'}
+
+    monkeypatch.setattr(webrtc, 'MAX_PENDING_SIGNALS', 4)
+    for n in range(4):
+        recipient = 'bob' if n % 2 else 'carol'
+        ack = alice.emit('ice_candidate', dict(candidate(n), recipient_id=recipient, call_id='call-1'), callback=True)
+        assert ack == {'status': 'buffered'}
+    ack = alice.emit('ice_candidate', dict(candidate(9), recipient_id='bob', call_id='call-1'), callback=True)
+    assert ack == {'error': 'Too many pending signals for this call'}
+    assert webrtc.call_sessions['call-1'].pending_count() == 4
+
+
+def test_join_limited_to_creator_and_invitees(peers):
+    alice, bob = peers
+    start_call(alice, 'alice', ['bob'])
+    alice.emit('offer', {'recipient_id': 'bob', 'call_id': 'call-1', 'offer': {'sdp': 'o1'}}, callback=True)
+
+    assert join_call(bob, 'carol') == {'error': 'Not invited to this call'}
+    assert received(bob) == []
+    assert webrtc.call_sessions['call-1'].participants == {'alice': alice.sid}
+    assert 'bob' in webrtc.call_sessions['call-1'].pending_signals
+
+
+def test_join_rejected_when_user_bound_to_another_socket(peers):
+    alice, bob = peers
+    start_call(alice, 'alice', ['bob', 'carol'])
+    start_call(alice, 'alice', ['bob'])  # duplicate start is refused, state untouched
+    alice.emit('offer', {'recipient_id': 'bob', 'call_id': 'call-1', 'offer': {'sdp': 'o1'}}, callback=True)
+
+    ack = join_call(bob, 'alice')
+    assert ack == {'error': 'User is already connected to this call'}
+    assert webrtc.call_sessions['call-1'].participants == {'alice': alice.sid}
+    assert received(bob) == []
+    assert received(alice) == []
+
+    # The real invitee still gets the buffered offer
+    assert join_call(bob, 'bob')['status'] == 'success'
+    assert [name for name, _ in received(bob)] == ['offer']
+    assert join_call(bob, 'carol') == {'error': 'Socket already joined this call as another user'}
+
+
+def test_user_can_rejoin_from_new_socket_after_old_one_leaves(peers):
+    alice, bob = peers
+    start_call(alice, 'alice', ['bob'])
+    join_call(bob, 'bob')
+
+    reopened = connect()
+    assert join_call(reopened, 'bob') == {'error': 'User is already connected to this call'}
+    bob.disconnect()
+    assert join_call(reopened, 'bob')['status'] == 'success'
+    assert webrtc.call_sessions['call-1'].participants == {'alice': alice.sid, 'bob': reopened.sid}
+    assert [name for name, _ in received(alice)] == ['peer_joined', 'peer_left', 'peer_joined']
+    reopened.disconnect()
+
+
+def test_queued_candidates_are_flushed_before_offer(peers):
+    alice, bob = peers
+    start_call(alice, 'alice', ['bob'])
+    join_call(bob, 'bob')
+    received(alice)
+
+    alice.emit('ice_candidate', dict(candidate(0), recipient_id='bob', call_id='call-1'), callback=True)
+    alice.emit('ice_candidate', dict(candidate(1), recipient_id='bob', call_id='call-1'), callback=True)
+    # ICE restart: new offer while the batch above is still in its window
+    alice.emit('offer', {'recipient_id': 'bob', 'call_id': 'call-1', 'offer': {'sdp': 'restart'}}, callback=True)
+
+    messages = received(bob)
+    assert [name for name, _ in messages] == ['ice_candidates', 'ice_candidates', 'offer']
+    assert [len(payload['candidates']) for _, payload in messages[:2]] == [1, 1]
+
+
+def test_offer_waits_for_batch_flush_in_progress(peers, monkeypatch):
+    alice, bob = peers
+    start_call(alice, 'alice', ['bob'])
+    join_call(bob, 'bob')
+    received(alice)
+
+    # Stall the background flush mid-emit and send an offer meanwhile
+    flushing = threading.Event()
+    original_emit = socketio.emit
+
+    def slow_emit(event, *args, **kwargs):
+        if event == 'ice_candidates' and threading.current_thread() is not threading.main_thread():
+            flushing.set()
+            time.sleep(SETTLE)
+        return original_emit(event, *args, **kwargs)
+
+    monkeypatch.setattr(socketio, 'emit', slow_emit)
+    alice.emit('ice_candidate', dict(candidate(0), recipient_id='bob', call_id='call-1'), callback=True)
+    alice.emit('ice_candidate', dict(candidate(1), recipient_id='bob', call_id='call-1'), callback=True)
+    assert flushing.wait(1)
+    alice.emit('offer', {'recipient_id': 'bob', 'call_id': 'call-1', 'offer': {'sdp': 'restart'}}, callback=True)
+
+    names = [name for name, _ in received(bob)]
+    assert names.index('offer') > max(i for i, name in enumerate(names) if name.startswith('ice_candidate'))
+
+
+def test_disconnect_notifies_peer_and_cleans_up(peers):
+    alice, bob = peers
+    start_call(alice, 'alice', ['bob'])
+    join_call(bob, 'bob')
+    bob.emit('ice_candidate', dict(candidate(0), recipient_id='alice', call_id='call-1'), callback=True)
+    received(alice)
+
+    bob.disconnect()
+    messages = received(alice)
+    assert messages == [('peer_left', {'call_id': 'call-1', 'user_id': 'bob'})]
+    assert webrtc.call_sessions['call-1'].participants == {'alice': alice.sid}
+    assert bob.sid not in webrtc.sid_calls
+
+    alice.disconnect()
+    assert webrtc.call_sessions == {}
+    assert webrtc.sid_calls == {}
+    assert webrtc.ice_batches == {}
+
+
+def test_signals_after_end_call_are_rejected(peers):
+    alice, bob = peers
+    start_call(alice, 'alice', ['bob'])
+    join_call(bob, 'bob')
+    received(alice)
+
+    assert alice.emit('end_call', {'call_id': 'call-1'}, callback=True) == {'status': 'success'}
+    assert received(bob) == [('call_ended', {'call_id': 'call-1', 'reason': 'ended by alice'})]
+
+    ack = alice.emit('offer', {'recipient_id': 'bob', 'call_id': 'call-1', 'offer': {'sdp': 'o1'}}, callback=True)
+    assert ack == {'error': 'Not a participant of this call'}
+    assert webrtc.call_sessions == {} and webrtc.sid_calls == {}
+
+
+def run_exchange(use_call):
+    """
+    One offer/answer with CANDIDATES_PER_PEER candidates each way, sent back
+    to back. Returns (messages received by both peers, seconds until the
+    first candidate reached the answerer, seconds until everything arrived).
+    """
+    reset_state()
+    alice, bob = connect(), connect()
+    extra = {}
+    alice_id, bob_id = alice.sid, bob.sid
+    if use_call:
+        start_call(alice, 'alice', ['bob'])
+        join_call(bob, 'bob')
+        received(alice)
+        extra = {'call_id': 'call-1'}
+        alice_id, bob_id = 'alice', 'bob'
+
+    messages, arrivals = [], []
+
+    def drain():
+        for client in (alice, bob):
+            for msg in client.get_received():
+                messages.append(msg)
+                count = len(msg['args'][0]['candidates']) if msg['name'] == 'ice_candidates' else 1
+                arrivals.extend([(msg['name'], time.perf_counter())] * count)
+
+    started = time.perf_counter()
+    alice.emit('offer', dict(extra, recipient_id=bob_id, offer={'sdp': 'offer'}), callback=True)
+    drain()
+    for n in range(CANDIDATES_PER_PEER):
+        alice.emit('ice_candidate', dict(candidate(n), recipient_id=bob_id, **extra), callback=True)
+        drain()
+    bob.emit('answer', dict(extra, sender_id=alice_id, answer={'sdp': 'answer'}), callback=True)
+    drain()
+    for n in range(CANDIDATES_PER_PEER):
+        bob.emit('ice_candidate', dict(candidate(100 + n), recipient_id=alice_id, **extra), callback=True)
+        drain()
+
+    expected = 2 * (CANDIDATES_PER_PEER + 1)
+    while len(arrivals) < expected and time.perf_counter() - started < 1:
+        time.sleep(0.0005)
+        drain()
+
+    first_candidate = next(at for name, at in arrivals if name.startswith('ice_candidate')) - started
+    everything = max(at for _, at in arrivals) - started
+
+    alice.disconnect()
+    bob.disconnect()
+    reset_state()
+    return messages, first_candidate, everything
+
+
+def test_call_path_sends_fewer_messages_without_delaying_first_candidate():
+    legacy, legacy_first, _ = run_exchange(use_call=False)
+    batched, batched_first, _ = run_exchange(use_call=True)
+    assert len(legacy) == 2 * (CANDIDATES_PER_PEER + 1)
+    assert len(batched) < len(legacy)
+    # The leading candidate is emitted inline, never after the batch window
+    assert batched_first < webrtc.ICE_BATCH_INTERVAL
+
+
+if __name__ == '__main__':
+    RUNS = 9
+    print(f"offer/answer + {CANDIDATES_PER_PEER} candidates each way, "
+          f"median of {RUNS} runs, ICE_BATCH_INTERVAL={webrtc.ICE_BATCH_INTERVAL * 1000:.0f} ms")
+    for label, use_call in (('per-message (before)', False), ('call session (after)', True)):
+        results = [run_exchange(use_call) for _ in range(RUNS)]
+        emits = statistics.median(len(messages) for messages, _, _ in results)
+        first = statistics.median(first for _, first, _ in results)
+        everything = statistics.median(everything for _, _, everything in results)
+        print(f"{label:22} {emits:4.0f} emits   first candidate {first * 1000:6.2f} ms   "
+              f"all delivered {everything * 1000:6.2f} ms")